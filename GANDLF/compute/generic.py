@@ -101,6 +101,21 @@ def create_pytorch_objects(
         model, amp=parameters["model"]["amp"], device=device, optimizer=optimizer
     )
 
+    # convert the convolution weights to the same layout as the inputs
+    if parameters.get("channels_last", False):
+        if parameters["model"]["dimension"] == 3:
+            memory_format, weight_rank = torch.channels_last_3d, 5
+        else:
+            memory_format, weight_rank = torch.channels_last, 4
+        # only tensors of the matching rank are converted, since 3D models can hold 2D
+        # convolution weights (such as the ACS converters of imagenet_unet);
+        # the data is replaced in-place, so the optimizer still refers to the parameters
+        for model_tensor in list(model.parameters()) + list(model.buffers()):
+            if model_tensor.dim() == weight_rank:
+                model_tensor.data = model_tensor.data.contiguous(
+                    memory_format=memory_format
+                )
+
     # only need to create scheduler if training
     if train_csv is not None:
         if not ("step_size" in parameters["scheduler"]):
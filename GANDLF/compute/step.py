@@ -62,6 +62,15 @@ def step(
                 if len(label.shape) > 1:
                     label = torch.squeeze(label, -1)
 
+    # channels-last layouts allow faster convolution kernels; this is done as late as possible, since any
+    # transform that calls ".contiguous()" would reset the layout
+    if params.get("channels_last", False):
+        image = image.contiguous(
+            memory_format=(
+                torch.channels_last_3d if image.dim() == 5 else torch.channels_last
+            )
+        )
+
     if not (train) and params["model"]["type"].lower() == "openvino":
         output = torch.from_numpy(
             model(inputs={params["model"]["IO"][0][0]: image.cpu().numpy()})[
@@ -9,6 +9,7 @@ import torchio
 from medcam import medcam
 
 from GANDLF.data import get_testing_loader
+from GANDLF.data.augmentation import get_gpu_augmentations, apply_gpu_augmentations
 from GANDLF.grad_clipping.grad_scaler import GradScaler, model_parameters_exclude_head
 from GANDLF.grad_clipping.clip_gradients import dispatch_clip_grad_
 from GANDLF.utils import (
@@ -77,6 +78,9 @@ def train_network(
         if params["verbose"]:
             print("Using Automatic mixed precision", flush=True)
 
+    # augmentations that are applied after the batch is sent to the device
+    gpu_augmentations = get_gpu_augmentations(params)
+
     # get ground truths
     if calculate_overall_metrics:
         (
@@ -106,6 +110,12 @@ def train_network(
             label = subject["label"][torchio.DATA]
         label = label.to(params["device"])
 
+        if gpu_augmentations is not None:
+            if "value_keys" in params:
+                image, _ = apply_gpu_augmentations(gpu_augmentations, image)
+            else:
+                image, label = apply_gpu_augmentations(gpu_augmentations, image, label)
+
         if params["save_training"]:
             write_training_patches(subject, params)
 
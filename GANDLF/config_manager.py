@@ -18,7 +18,11 @@ parameter_defaults = {
     "save_training": False,  # save outputs during training
     "save_output": False,  # save outputs during validation/testing
     "in_memory": False,  # pin data to cpu memory
+    "quantize_in_memory": False,  # store in-memory intensity images in 16 bits
     "pin_memory_dataloader": False,  # pin data to gpu memory
+    "gpu_augmentations": None,  # augmentations to apply on the device after the batch is created
+    "channels_last": False,  # use channels-last memory layout for the model inputs and weights
+    "gpu_prefetch": False,  # copy the next training batch to the gpu while the current one is processed
     "scaling_factor": 1,  # scaling factor for regression problems
     "q_max_length": 100,  # the max length of queue
     "q_samples_per_volume": 10,  # number of samples per volume
@@ -29,6 +33,11 @@ parameter_defaults = {
     "learning_rate": 0.001,  # default learning rate
     "clip_grad": None,  # clip_gradient value
     "track_memory_usage": False,  # default memory tracking
+    "cache_backend": None,  # if set to "zarr", preprocessed images are served from a chunked on-disk cache
+    "lazy_dataset": False,  # construct the subjects on demand in the data loader workers instead of up front
+    "page_cache_prefetch": False,  # read the input images into the os page cache in the background (linux only)
+    "resize_cache": False,  # keep the resized images in a cache under `output_dir`, to be re-used by later runs with the same `output_dir`
+    "gpu_resize": False,  # perform the resize operations in `data_preprocessing` on the gpu, if available
     "memory_save_mode": False,  # default memory saving, if enabled, resize/resample will save files to disk
     "print_rgb_label_warning": True,  # print rgb label warning
     "data_postprocessing": {},  # default data postprocessing
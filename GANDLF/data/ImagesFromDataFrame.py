@@ -1,22 +1,29 @@
-from typing import Optional, Union
-import os
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import os, threading, hashlib, json, shutil
+from functools import lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import numpy as np
 
 import pandas
 import torch
 import torchio
-from torchio.transforms import Pad
+from torchio.transforms import Pad, Compose
 import SimpleITK as sitk
+import nibabel as nib
+import zarr
 from tqdm import tqdm
 
 from GANDLF.utils import (
     perform_sanity_check_on_subject,
-    resize_image,
+    resize_images_batch,
+    resize_image_gpu,
     get_filename_extension_sanitized,
     get_correct_padding_size,
 )
 from .preprocessing import get_transforms_for_preprocessing
+from .preprocessing.quantization import quantize_subject, Dequantize
 from .augmentation import global_augs_dict
 
 global_sampler_dict = {
@@ -31,6 +38,587 @@ global_sampler_dict = {
     "weightedsample": torchio.data.WeightedSampler,
 }
 
+# the different names under which the resize preprocessing and the samplers can be requested
+_RESIZE_KEYS = frozenset({"resize", "resize_image", "resize_images"})
+_WEIGHTED = frozenset({"weighted", "weightedsampler", "weightedsample"})
+_LABEL = frozenset({"label", "labelsampler", "labelsample"})
+
+
+# header readers are not thread-safe, so each worker thread keeps its own
+_thread_local = threading.local()
+
+
+# the factors to convert the spatial units of NIfTI headers to millimeters
+_NIFTI_SPATIAL_UNIT_SCALES = {"meter": 1000.0, "mm": 1.0, "micron": 0.001}
+
+
+@lru_cache(maxsize=None)
+def _read_spacing(path: str, mtime: float) -> Tuple[float, ...]:
+    """
+    Reads the spacing of an image from its header without loading the pixel data.
+
+    Args:
+        path (str): The path to the image.
+        mtime (float): The modification time of the image; part of the cache key, so that rewritten files are read again.
+
+    Returns:
+        Tuple[float, ...]: The spacing of the image.
+    """
+    # NIfTI headers can be parsed directly, without setting up an ITK reader
+    if path.lower().endswith((".nii", ".nii.gz")):
+        header = nib.load(path, mmap=True).header
+        # as in the ITK reader, the spacing is converted to millimeters
+        scale = _NIFTI_SPATIAL_UNIT_SCALES.get(header.get_xyzt_units()[0], 1.0)
+        return tuple(float(zoom) * scale for zoom in header.get_zooms()[:3])
+
+    file_reader = getattr(_thread_local, "file_reader", None)
+    if file_reader is None:
+        file_reader = sitk.ImageFileReader()
+        _thread_local.file_reader = file_reader
+    file_reader.SetFileName(path)
+    file_reader.ReadImageInformation()
+    return file_reader.GetSpacing()
+
+
+# resized images are cached in a lossless format that supports multi-component pixels,
+# regardless of the format of the source images (which might be lossy, such as jpg)
+_RESIZE_CACHE_EXTENSION = ".nrrd"
+
+
+def _resized_cached(
+    images: List[torchio.Image],
+    src_paths: List[str],
+    target_size: Union[list, dict],
+    interpolators: List[int],
+    output_dir: Optional[str] = None,
+    use_gpu: Optional[bool] = False,
+) -> List[sitk.Image]:
+    """
+    Resizes the images of a subject together, re-using previously resized copies from the on-disk cache if present.
+
+    Args:
+        images (List[torchio.Image]): The images to resize.
+        src_paths (List[str]): The paths of the images on disk, used to construct the cache keys.
+        target_size (Union[list, dict]): The target size, as passed to resize_image.
+        interpolators (List[int]): The SimpleITK interpolator of each image.
+        output_dir (Optional[str], optional): The output directory under which the cache is kept; caching is disabled if None. Defaults to None.
+        use_gpu (Optional[bool], optional): Whether to resize on the GPU. Defaults to False.
+
+    Returns:
+        List[sitk.Image]: The resized images.
+    """
+    images_resized = [None] * len(images)
+    cache_keys = [None] * len(images)
+    if output_dir is not None:
+        cache_dir = os.path.join(output_dir, "_resize_cache")
+        for i, (src_path, interpolator) in enumerate(zip(src_paths, interpolators)):
+            cache_keys[i] = hashlib.blake2b(
+                f"{src_path}|{os.path.getmtime(src_path)}|{target_size}|{interpolator}|{use_gpu}".encode()
+            ).hexdigest()[:16]
+            cache_path = os.path.join(
+                cache_dir, cache_keys[i] + _RESIZE_CACHE_EXTENSION
+            )
+            if os.path.isfile(cache_path):
+                images_resized[i] = sitk.ReadImage(cache_path)
+
+    to_resize = [i for i, image in enumerate(images_resized) if image is None]
+    if not to_resize:
+        return images_resized
+    if use_gpu:
+        for i in to_resize:
+            images_resized[i] = resize_image_gpu(
+                images[i].as_sitk(), target_size, interpolators[i]
+            )
+    else:
+        # the images of a subject share their geometry, so the output grid is computed once
+        for i, image_resized in zip(
+            to_resize,
+            resize_images_batch(
+                [images[i].as_sitk() for i in to_resize],
+                target_size,
+                [interpolators[i] for i in to_resize],
+            ),
+        ):
+            images_resized[i] = image_resized
+
+    if output_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        for i in to_resize:
+            # write to a unique temporary file first so that concurrent writers never expose a partial file
+            temp_path = os.path.join(
+                cache_dir,
+                f"{cache_keys[i]}_{os.getpid()}_{threading.get_ident()}{_RESIZE_CACHE_EXTENSION}",
+            )
+            sitk.WriteImage(images_resized[i], temp_path, useCompression=True)
+            os.replace(
+                temp_path,
+                os.path.join(cache_dir, cache_keys[i] + _RESIZE_CACHE_EXTENSION),
+            )
+    return images_resized
+
+
+def _check_files_exist(paths: List[str]) -> Dict[str, bool]:
+    """
+    Checks the existence of many files at once. Directories containing several of the paths are listed with a single scan, and the paths not found by a scan (for example, those differing in case on case-insensitive filesystems) are checked concurrently along with the remaining ones.
+
+    Args:
+        paths (List[str]): The paths to check.
+
+    Returns:
+        Dict[str, bool]: The existence of each path.
+    """
+    paths_per_dir = defaultdict(list)
+    for path in set(paths):
+        paths_per_dir[os.path.dirname(os.path.abspath(path))].append(path)
+
+    existence, paths_to_stat = {}, []
+    for dirname, paths_in_dir in paths_per_dir.items():
+        if len(paths_in_dir) == 1:
+            paths_to_stat.extend(paths_in_dir)
+            continue
+        try:
+            with os.scandir(dirname) as entries:
+                files_in_dir = {entry.name for entry in entries if entry.is_file()}
+        except OSError:
+            files_in_dir = set()
+        for path in paths_in_dir:
+            # a listed name proves the existence of the file, but a missing one does not prove its absence
+            if os.path.basename(path) in files_in_dir:
+                existence[path] = True
+            else:
+                paths_to_stat.append(path)
+
+    # stat calls are I/O bound (especially on network filesystems), so threads are sufficient
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        existence.update(
+            zip(paths_to_stat, executor.map(os.path.isfile, paths_to_stat))
+        )
+    return existence
+
+
+def _get_sanity_check_key(paths: List[str], preprocessing_key: str) -> str:
+    """
+    Computes the key under which a subject is recorded in the sanity check manifest.
+
+    Args:
+        paths (List[str]): The image paths of the subject.
+        preprocessing_key (str): Identifies the preprocessing applied to the images before the check (resizing, memory save mode).
+
+    Returns:
+        str: The key, which changes whenever any of the images or the preprocessing is modified.
+    """
+    paths = sorted(paths)
+    return hashlib.blake2b(
+        "|".join(
+            paths
+            + [str(os.path.getmtime(path)) for path in paths]
+            + [preprocessing_key]
+        ).encode()
+    ).hexdigest()
+
+
+def _read_zarr(path: Union[str, Path]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reader for torchio images that are stored as zarr arrays by _materialize_to_zarr.
+
+    Args:
+        path (Union[str, Path]): The path to the zarr array.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The image data and its affine matrix.
+    """
+    store = zarr.open(str(path), mode="r")
+    data = np.asarray(store)
+    # intensities may be stored in half precision, but are always processed in single precision
+    if data.dtype == np.float16:
+        data = data.astype(np.float32)
+    return data, np.array(store.attrs["affine"])
+
+
+def _get_zarr_dtype(data: np.ndarray) -> np.dtype:
+    """
+    Determines the dtype in which an intensity image is stored in the zarr cache: integer-valued images are stored exactly as int16 if their range allows it, and all others use half precision unless their values exceed its range.
+
+    Args:
+        data (np.ndarray): The image data.
+
+    Returns:
+        np.dtype: The dtype in which to store the image.
+    """
+    if data.size == 0 or data.dtype.itemsize <= 2:
+        return data.dtype
+    data_min, data_max = data.min(), data.max()
+    if np.array_equal(data, np.round(data)):
+        int16_info = np.iinfo(np.int16)
+        if int16_info.min <= data_min and data_max <= int16_info.max:
+            return np.dtype(np.int16)
+        return data.dtype
+    if max(abs(data_min), abs(data_max)) <= np.finfo(np.float16).max:
+        return np.dtype(np.float16)
+    return np.dtype(np.float32)
+
+
+def _materialize_to_zarr(
+    subject: torchio.Subject,
+    source_paths: Dict[str, str],
+    root: str,
+    patch_size: List[int],
+    preprocessing_key: str,
+) -> torchio.Subject:
+    """
+    Writes the images of a subject to zarr arrays (once) and replaces them with lazily-loaded images backed by those arrays.
+
+    Args:
+        subject (torchio.Subject): The subject to materialize.
+        source_paths (Dict[str, str]): The source path of each image in the subject, keyed by the image key.
+        root (str): The root directory of the zarr cache.
+        patch_size (List[int]): The patch size, used to chunk the arrays.
+        preprocessing_key (str): Identifies the preprocessing applied before materialization; arrays written with a different key are re-written.
+
+    Returns:
+        torchio.Subject: The subject with images read from the zarr cache.
+    """
+    subject_dir = os.path.join(root, subject["subject_id"])
+    for key, source_path in source_paths.items():
+        image = subject[key]
+        source_key = (
+            f"{source_path}|{os.path.getmtime(source_path)}|{preprocessing_key}"
+        )
+        store_path = os.path.join(subject_dir, key + ".zarr")
+        is_current = False
+        if os.path.isdir(store_path):
+            is_current = (
+                zarr.open(store_path, mode="r").attrs.get("source") == source_key
+            )
+        if not is_current:
+            data = image.data.numpy()
+            dtype = (
+                _get_zarr_dtype(data) if image.type == torchio.INTENSITY else data.dtype
+            )
+            # write to a temporary location first so that readers never see a partial array
+            temp_path = store_path + f".{os.getpid()}_{threading.get_ident()}"
+            store = zarr.open(
+                temp_path,
+                mode="w",
+                shape=data.shape,
+                chunks=(data.shape[0],)
+                + tuple(min(p, s) for p, s in zip(patch_size, data.shape[1:])),
+                dtype=dtype,
+            )
+            store[:] = data
+            store.attrs["affine"] = image.affine.tolist()
+            store.attrs["spacing"] = list(image.spacing)
+            store.attrs["source"] = source_key
+            if os.path.isdir(store_path):
+                shutil.rmtree(store_path, ignore_errors=True)
+            try:
+                os.replace(temp_path, store_path)
+            except OSError:
+                # another worker has written the same array in the meantime
+                shutil.rmtree(temp_path, ignore_errors=True)
+        subject[key] = type(image)(store_path, reader=_read_zarr)
+    return subject
+
+
+def _prefetch_paths(paths: List[str]) -> None:
+    """
+    Advises the kernel that the given files will be needed soon, so that they are read into the page cache in the background.
+
+    Args:
+        paths (List[str]): The paths to prefetch.
+    """
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def _save_resized_images(
+    resized_image: sitk.Image,
+    output_dir: str,
+    subject_id: str,
+    channel_str: str,
+    loader_type: str,
+    extension: str,
+) -> None:
+    """
+    Helper function to save the resized images
+
+    Args:
+        resized_image (sitk.Image): The resized image.
+        output_dir (str): The output directory.
+        subject_id (str): The subject ID.
+        channel_str (str): The channel string.
+        loader_type (str): The loader type.
+        extension (str): The extension of the image.
+    """
+    # save img_resized to disk
+    save_dir_for_resized_images = os.path.join(
+        output_dir, loader_type + "_resized_images"
+    )
+    Path(save_dir_for_resized_images).mkdir(parents=True, exist_ok=True)
+    save_path = os.path.join(
+        save_dir_for_resized_images,
+        subject_id + "_" + channel_str + "_resized" + extension,
+    )
+    if not os.path.isfile(save_path):
+        sitk.WriteImage(resized_image, save_path)
+
+
+def _build_subject(
+    row: dict,
+    headers: dict,
+    preprocessing: dict,
+    resize_images_flag: bool,
+    parameters: dict,
+    loader_type: str,
+    existence: Dict[str, bool],
+    validated_subjects: set,
+    extensions: Dict[str, str],
+    padder: Optional[Pad],
+) -> Tuple[Optional[torchio.Subject], Optional[str]]:
+    """
+    Constructs the torchio.Subject for a single row of the input dataframe.
+
+    Args:
+        row (dict): The cells of the row, keyed by the dataframe column index; the subject ID and image paths are strings.
+        headers (dict): The headers dictionary.
+        preprocessing (dict): The preprocessing dictionary.
+        resize_images_flag (bool): Whether the images need to be resized.
+        parameters (dict): The parameters dictionary.
+        loader_type (str): The type of loader.
+        existence (Dict[str, bool]): The existence of the image paths, as computed by _check_files_exist.
+        validated_subjects (set): The keys of subjects that have passed the sanity check; updated in-place.
+        extensions (Dict[str, str]): The sanitized file extension of each image header.
+        padder (Optional[Pad]): The padding transform, if padding is enabled.
+
+    Returns:
+        Tuple[Optional[torchio.Subject], Optional[str]]: The subject (None if it was skipped due to missing files) and the subject ID if it failed the sanity check (None otherwise).
+    """
+    channelHeaders = headers["channelHeaders"]
+    labelHeader = headers["labelHeader"]
+    predictionHeaders = headers["predictionHeaders"]
+    subjectIDHeader = headers["subjectIDHeader"]
+
+    # We need this dict for storing the meta data for each subject
+    # such as different image modalities, labels, any other data
+    subject_dict = {}
+    subject_dict["subject_id"] = row[subjectIDHeader]
+    skip_subject = False
+    gpu_resize = parameters.get("gpu_resize", False) and torch.cuda.is_available()
+    # iterating through the channels/modalities/timepoints of the subject
+    for channel in channelHeaders:
+        channel_path = row[channel]
+        # sanity check for malformed csv
+        if not existence[channel_path]:
+            skip_subject = True
+
+        subject_dict[str(channel)] = torchio.ScalarImage(channel_path)
+
+    # # for regression -- this logic needs to be thought through
+    # if predictionHeaders:
+    #     # get the mask
+    #     if (subject_dict['label'] is None) and (class_list is not None):
+    #         sys.exit('The \'class_list\' parameter has been defined but a label file is not present for patient: ', patient)
+
+    if labelHeader is not None:
+        label_path = row[labelHeader]
+        if not existence[label_path]:
+            skip_subject = True
+
+        subject_dict["label"] = torchio.LabelMap(label_path)
+        subject_dict["path_to_metadata"] = label_path
+
+    else:
+        subject_dict["label"] = "NA"
+        subject_dict["path_to_metadata"] = channel_path
+
+    # if resize is requested, the perform the resize of all images together with appropriate interpolators
+    if resize_images_flag:
+        image_keys = [str(channel) for channel in channelHeaders]
+        src_paths = [row[channel] for channel in channelHeaders]
+        interpolators = [sitk.sitkLinear] * len(channelHeaders)
+        image_extensions = [extensions[channel] for channel in channelHeaders]
+        if labelHeader is not None:
+            image_keys.append("label")
+            src_paths.append(label_path)
+            interpolators.append(sitk.sitkNearestNeighbor)
+            image_extensions.append(extensions[labelHeader])
+        images_resized = _resized_cached(
+            [subject_dict[key] for key in image_keys],
+            src_paths,
+            preprocessing["resize_image"],
+            interpolators,
+            (
+                parameters.get("output_dir")
+                if parameters.get("resize_cache", False)
+                else None
+            ),
+            gpu_resize,
+        )
+        for key, img_resized, extension in zip(
+            image_keys, images_resized, image_extensions
+        ):
+            if parameters["memory_save_mode"]:
+                _save_resized_images(
+                    img_resized,
+                    parameters["output_dir"],
+                    subject_dict["subject_id"],
+                    key,
+                    loader_type,
+                    # the label is saved with the extension of the last channel
+                    extensions[channel] if key == "label" else extension,
+                )
+            elif key == "label":
+                subject_dict["label"] = torchio.LabelMap.from_sitk(img_resized)
+            else:
+                # always ensure resized image spacing is used
+                subject_dict["spacing"] = torch.Tensor(img_resized.GetSpacing())
+                subject_dict[key] = torchio.ScalarImage.from_sitk(img_resized)
+
+    # store image spacing information if not already taken from the resized images
+    if "spacing" not in subject_dict:
+        spacing_path = row[channelHeaders[0]]
+        subject_dict["spacing"] = torch.Tensor(
+            _read_spacing(spacing_path, os.path.getmtime(spacing_path))
+        )
+
+    # iterating through the values to predict of the subject
+    valueCounter = 0
+    for values in predictionHeaders:
+        # assigning the dict key to the channel
+        subject_dict["value_" + str(valueCounter)] = np.array(row[values])
+        valueCounter += 1
+
+    # skip subject the condition was tripped
+    if skip_subject:
+        return None, None
+
+    subject_id_error = None
+    # Initializing the subject object using the dict
+    subject = torchio.Subject(subject_dict)
+    # subjects whose images have not changed since they last passed the check are not re-checked
+    image_paths = [row[channel] for channel in channelHeaders]
+    image_keys_for_check = [str(channel) for channel in channelHeaders]
+    if labelHeader is not None:
+        image_paths.append(label_path)
+        image_keys_for_check.append("label")
+    sanity_check_key = _get_sanity_check_key(
+        image_paths,
+        str(preprocessing.get("resize_image") if resize_images_flag else None)
+        + "|"
+        + str(parameters["memory_save_mode"]),
+    )
+    if sanity_check_key not in validated_subjects:
+        # https://github.com/fepegar/torchio/discussions/587#discussioncomment-928834
+        # this is causing memory usage to explode, see https://github.com/mlcommons/GaNDLF/issues/128
+        if parameters["verbose"]:
+            print(
+                "Checking consistency of images in subject '"
+                + subject["subject_id"]
+                + "'"
+            )
+        try:
+            perform_sanity_check_on_subject(subject, parameters)
+            # images resized in memory have no path, and are not actually compared by the check
+            if all(subject[key]["path"] != "" for key in image_keys_for_check):
+                validated_subjects.add(sanity_check_key)
+        except Exception as exception:
+            subject_id_error = subject["subject_id"]
+            print(
+                "Subject '"
+                + subject["subject_id"]
+                + "' could not be loaded due to the following exception: {}".format(
+                    type(exception).__name__
+                )
+                + "; message: {}".format(exception)
+            )
+
+    # serve the (preprocessed) images from a chunked store instead of re-decoding the source files
+    if parameters.get("cache_backend", None) == "zarr" and not (
+        parameters.get("output_dir") is None
+    ):
+        source_paths = {str(channel): row[channel] for channel in channelHeaders}
+        if labelHeader is not None:
+            source_paths["label"] = label_path
+        subject = _materialize_to_zarr(
+            subject,
+            source_paths,
+            os.path.join(parameters["output_dir"], "_zarr_cache"),
+            parameters["patch_size"],
+            str(preprocessing.get("resize_image") if resize_images_flag else None),
+        )
+
+    # # padding image, but only for label sampler, because we don't want to pad for uniform
+    if padder is not None:
+        subject = padder(subject)
+
+    # load subject into memory: https://github.com/fepegar/torchio/discussions/568#discussioncomment-859027
+    if parameters["in_memory"]:
+        subject.load()
+        if parameters.get("quantize_in_memory", False):
+            subject = quantize_subject(subject)
+
+    return subject, subject_id_error
+
+
+class LazySubjectsDataset(torch.utils.data.IterableDataset):
+    def __init__(
+        self,
+        columns: Dict[int, np.ndarray],
+        build_args: tuple,
+        transform: Optional[Callable] = None,
+        shuffle: Optional[bool] = False,
+    ) -> None:
+        """
+        Dataset that constructs the subjects of a dataframe on demand instead of keeping all of them in memory. When used with multiple workers, each worker constructs a disjoint subset of the rows.
+
+        Args:
+            columns (Dict[int, np.ndarray]): The snapshot of the relevant columns of the dataframe.
+            build_args (tuple): The arguments passed to _build_subject after the row.
+            transform (Optional[Callable], optional): The transform to apply to each subject. Defaults to None.
+            shuffle (Optional[bool], optional): Whether to shuffle the rows in each iteration. Defaults to False.
+        """
+        self.columns = columns
+        self.build_args = build_args
+        self.transform = transform
+        self.shuffle = shuffle
+        self.num_rows = len(next(iter(columns.values()))) if columns else 0
+
+    def __len__(self) -> int:
+        # subjects with missing files are skipped, so this is an upper bound
+        return self.num_rows
+
+    def __iter__(self) -> Iterator[torchio.Subject]:
+        rows = np.arange(self.num_rows)
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            rows = rows[worker_info.id :: worker_info.num_workers]
+        if self.shuffle:
+            rows = np.random.permutation(rows)
+        for patient in rows:
+            subject, subject_id_error = _build_subject(
+                {header: column[patient] for header, column in self.columns.items()},
+                *self.build_args,
+            )
+            if subject_id_error is not None:
+                print(
+                    f"WARNING: subject '{subject_id_error}' could not be loaded, please recheck or remove and retry",
+                    flush=True,
+                )
+            if subject is None:
+                continue
+            if self.transform is not None:
+                subject = self.transform(subject)
+            yield subject
+
 
 # This function takes in a dataframe, with some other parameters and returns the dataloader
 def ImagesFromDataFrame(
@@ -39,7 +627,7 @@ def ImagesFromDataFrame(
     train: bool,
     apply_zero_crop: Optional[bool] = False,
     loader_type: Optional[str] = None,
-) -> Union[torchio.SubjectsDataset, torchio.Queue]:
+) -> Union[torchio.SubjectsDataset, LazySubjectsDataset, torchio.Queue]:
     """
     Reads the pandas dataframe and gives the dataloader to use for training/validation/testing.
 
@@ -51,7 +639,7 @@ def ImagesFromDataFrame(
         loader_type (Optional[str], optional): The type of loader. Defaults to None.
 
     Returns:
-        Union[torchio.SubjectsDataset, torchio.Queue]: The dataloader queue for validation/testing (where patching and data augmentation is not required) or the subjects dataset for training.
+        Union[torchio.SubjectsDataset, LazySubjectsDataset, torchio.Queue]: The dataloader queue for validation/testing (where patching and data augmentation is not required) or the subjects dataset for training.
     """
     loader_type = loader_type if loader_type is not None else ""
     # store in previous variable names
@@ -63,7 +651,6 @@ def ImagesFromDataFrame(
     q_verbose = parameters["q_verbose"]
     augmentations = parameters["data_augmentation"]
     preprocessing = parameters["data_preprocessing"]
-    in_memory = parameters["in_memory"]
     sampler = parameters["patch_sampler"]
 
     # Finding the dimension of the dataframe for computational purposes later
@@ -83,187 +670,96 @@ def ImagesFromDataFrame(
     resize_images_flag = False
     # if resize has been defined but resample is not (or is none)
     if not (preprocessing is None):
-        for key in preprocessing.keys():
-            # check for different resizing keys
-            if key in ["resize", "resize_image", "resize_images"]:
-                if not (preprocessing[key] is None):
-                    resize_images_flag = True
-                    preprocessing["resize_image"] = preprocessing[key]
-                    break
-
-    # helper function to save the resized images
-    def _save_resized_images(
-        resized_image, output_dir, subject_id, channel_str, loader_type, extension
-    ):
-        """
-        Helper function to save the resized images
-
-        Args:
-            resized_image (sitk.Image): The resized image.
-            output_dir (str): The output directory.
-            subject_id (str): The subject ID.
-            channel_str (str): The channel string.
-            loader_type (str): The loader type.
-            extension (str): The extension of the image.
-        """
-        # save img_resized to disk
-        save_dir_for_resized_images = os.path.join(
-            output_dir, loader_type + "_resized_images"
+        # the first resizing key (in the order of the configuration) that is set is used
+        hit = next(
+            (
+                key
+                for key in preprocessing
+                if key in _RESIZE_KEYS and preprocessing[key] is not None
+            ),
+            None,
         )
-        Path(save_dir_for_resized_images).mkdir(parents=True, exist_ok=True)
-        save_path = os.path.join(
-            save_dir_for_resized_images,
-            subject_id + "_" + channel_str + "_resized" + extension,
+        if hit is not None:
+            resize_images_flag = True
+            preprocessing["resize_image"] = preprocessing[hit]
+
+    # snapshot the relevant columns once, so that each row is a cheap array lookup
+    # the subject IDs and paths are converted to strings here, once for all subjects
+    columns = {
+        header: dataframe[header].astype(str).to_numpy(dtype=object)
+        for header in [subjectIDHeader] + list(channelHeaders)
+    }
+    if labelHeader is not None:
+        columns[labelHeader] = dataframe[labelHeader].astype(str).to_numpy(dtype=object)
+    for values in predictionHeaders:
+        columns[values] = dataframe[values].to_numpy()
+    # check all image paths in one batch rather than one stat per image
+    image_headers = list(channelHeaders)
+    if labelHeader is not None:
+        image_headers.append(labelHeader)
+    image_paths = [path for header in image_headers for path in columns[header]]
+    existence = _check_files_exist(image_paths)
+
+    # ask the kernel to start reading the images while the subjects are being constructed
+    if parameters.get("page_cache_prefetch", False) and hasattr(os, "posix_fadvise"):
+        threading.Thread(
+            target=_prefetch_paths,
+            args=([path for path in image_paths if existence[path]],),
+            daemon=True,
+        ).start()
+
+    # the extensions of the images are assumed to be consistent within each header; they
+    # only determine the format in which resized images are written
+    extensions = {}
+    if num_row > 0:
+        extensions = {
+            header: get_filename_extension_sanitized(str(columns[header][0]))
+            for header in image_headers
+        }
+
+    # the padding transform is the same for all subjects
+    padder = None
+    if sampler["enable_padding"]:
+        psize_pad = get_correct_padding_size(
+            patch_size, parameters["model"]["dimension"]
         )
-        if not os.path.isfile(save_path):
-            sitk.WriteImage(resized_image, save_path)
-
-    # iterating through the dataframe
-    for patient in tqdm(
-        range(num_row), desc="Constructing queue for " + loader_type + " data"
-    ):
-        # We need this dict for storing the meta data for each subject
-        # such as different image modalities, labels, any other data
-        subject_dict = {}
-        subject_dict["subject_id"] = str(dataframe[subjectIDHeader][patient])
-        skip_subject = False
-        # iterating through the channels/modalities/timepoints of the subject
-        for channel in channelHeaders:
-            # sanity check for malformed csv
-            if not os.path.isfile(str(dataframe[channel][patient])):
-                skip_subject = True
-
-            subject_dict[str(channel)] = torchio.ScalarImage(
-                dataframe[channel][patient]
-            )
-
-            # store image spacing information if not present
-            if "spacing" not in subject_dict:
-                file_reader = sitk.ImageFileReader()
-                file_reader.SetFileName(str(dataframe[channel][patient]))
-                file_reader.ReadImageInformation()
-                subject_dict["spacing"] = torch.Tensor(file_reader.GetSpacing())
-
-            # if resize_image is requested, the perform per-image resize with appropriate interpolator
-            if resize_images_flag:
-                img_resized = resize_image(
-                    subject_dict[str(channel)].as_sitk(), preprocessing["resize_image"]
-                )
-                if parameters["memory_save_mode"]:
-                    _save_resized_images(
-                        img_resized,
-                        parameters["output_dir"],
-                        subject_dict["subject_id"],
-                        str(channel),
-                        loader_type,
-                        get_filename_extension_sanitized(
-                            str(dataframe[channel][patient])
-                        ),
-                    )
-                else:
-                    # always ensure resized image spacing is used
-                    subject_dict["spacing"] = torch.Tensor(img_resized.GetSpacing())
-                    subject_dict[str(channel)] = torchio.ScalarImage.from_sitk(
-                        img_resized
-                    )
-
-        # # for regression -- this logic needs to be thought through
-        # if predictionHeaders:
-        #     # get the mask
-        #     if (subject_dict['label'] is None) and (class_list is not None):
-        #         sys.exit('The \'class_list\' parameter has been defined but a label file is not present for patient: ', patient)
-
-        if labelHeader is not None:
-            if not os.path.isfile(str(dataframe[labelHeader][patient])):
-                skip_subject = True
-
-            subject_dict["label"] = torchio.LabelMap(dataframe[labelHeader][patient])
-            subject_dict["path_to_metadata"] = str(dataframe[labelHeader][patient])
-
-            # if resize is requested, the perform per-image resize with appropriate interpolator
-            if resize_images_flag:
-                img_resized = resize_image(
-                    subject_dict["label"].as_sitk(),
-                    preprocessing["resize_image"],
-                    sitk.sitkNearestNeighbor,
-                )
-                if parameters["memory_save_mode"]:
-                    _save_resized_images(
-                        img_resized,
-                        parameters["output_dir"],
-                        subject_dict["subject_id"],
-                        "label",
-                        loader_type,
-                        get_filename_extension_sanitized(
-                            str(dataframe[channel][patient])
-                        ),
-                    )
-                else:
-                    subject_dict["label"] = torchio.LabelMap.from_sitk(img_resized)
-
-        else:
-            subject_dict["label"] = "NA"
-            subject_dict["path_to_metadata"] = str(dataframe[channel][patient])
-
-        # iterating through the values to predict of the subject
-        valueCounter = 0
-        for values in predictionHeaders:
-            # assigning the dict key to the channel
-            subject_dict["value_" + str(valueCounter)] = np.array(
-                dataframe[values][patient]
-            )
-            valueCounter += 1
-
-        # skip subject the condition was tripped
-        if not skip_subject:
-            # Initializing the subject object using the dict
-            subject = torchio.Subject(subject_dict)
-            # https://github.com/fepegar/torchio/discussions/587#discussioncomment-928834
-            # this is causing memory usage to explode, see https://github.com/mlcommons/GaNDLF/issues/128
-            if parameters["verbose"]:
-                print(
-                    "Checking consistency of images in subject '"
-                    + subject["subject_id"]
-                    + "'"
-                )
-            try:
-                perform_sanity_check_on_subject(subject, parameters)
-            except Exception as exception:
-                subjects_with_error.append(subject["subject_id"])
-                print(
-                    "Subject '"
-                    + subject["subject_id"]
-                    + "' could not be loaded due to the following exception: {}".format(
-                        type(exception).__name__
-                    )
-                    + "; message: {}".format(exception)
-                )
-
-            # # padding image, but only for label sampler, because we don't want to pad for uniform
-            if sampler["enable_padding"]:
-                psize_pad = get_correct_padding_size(
-                    patch_size, parameters["model"]["dimension"]
-                )
-                padder = Pad(psize_pad, padding_mode=sampler["padding_mode"])
-                subject = padder(subject)
-
-            # load subject into memory: https://github.com/fepegar/torchio/discussions/568#discussioncomment-859027
-            if in_memory:
-                subject.load()
-
-            # Appending this subject to the list of subjects
-            subjects_list.append(subject)
-
-    assert (
-        subjects_with_error is not None
-    ), f"The following subjects could not be loaded, please recheck or remove and retry: {subjects_with_error}"
+        padder = Pad(psize_pad, padding_mode=sampler["padding_mode"])
+
+    # the manifest of subjects that have passed the sanity check in previous constructions;
+    # there is no separate logs directory in the parameters, so it is kept in the output
+    # directory along with the other caches
+    sanity_manifest_path = None
+    validated_subjects = set()
+    if parameters.get("output_dir") is not None:
+        sanity_manifest_path = os.path.join(parameters["output_dir"], "sanity_ok.json")
+        if os.path.isfile(sanity_manifest_path):
+            with open(sanity_manifest_path) as f:
+                validated_subjects = set(json.load(f))
+
+    build_args = (
+        headers,
+        preprocessing,
+        resize_images_flag,
+        parameters,
+        loader_type,
+        existence,
+        validated_subjects,
+        extensions,
+        padder,
+    )
 
     transformations_list = []
 
     # augmentations are applied to the training set only
     if train and not (augmentations is None):
+        # these are applied on the device during training
+        gpu_augmentations = [
+            aug.lower() for aug in (parameters.get("gpu_augmentations", None) or [])
+        ]
         for aug in augmentations:
             aug_lower = aug.lower()
+            if aug_lower in gpu_augmentations:
+                continue
             if aug_lower in global_augs_dict:
                 transformations_list.append(
                     global_augs_dict[aug_lower](augmentations[aug])
@@ -272,18 +768,75 @@ def ImagesFromDataFrame(
     transform = get_transforms_for_preprocessing(
         parameters, transformations_list, train, apply_zero_crop
     )
+    # quantized subjects need to be restored before any other transform is applied
+    if parameters["in_memory"] and parameters.get("quantize_in_memory", False):
+        transform = Compose(
+            [Dequantize()] + ([transform] if transform is not None else [])
+        )
 
-    subjects_dataset = torchio.SubjectsDataset(subjects_list, transform=transform)
+    lazy_dataset = parameters.get("lazy_dataset", False)
+    if lazy_dataset:
+        # the data loader workers are forked, and cannot use CUDA once the parent has initialized it
+        assert not parameters.get(
+            "gpu_resize", False
+        ), "'gpu_resize' cannot be used together with 'lazy_dataset', please disable one of them"
+        # the subjects are constructed (and validated) by the data loader workers as they are needed;
+        # each worker only sees a copy of the loaded manifest, so subjects that are not in it are
+        # sanity-checked again in every epoch
+        subjects_dataset = LazySubjectsDataset(
+            columns, build_args, transform=transform, shuffle=train
+        )
+    else:
+        # subjects are independent of each other, so they are constructed in parallel;
+        # SimpleITK releases the GIL during I/O and resampling, so threads are sufficient
+        results = [None] * num_row
+        with ThreadPoolExecutor(
+            max_workers=q_num_workers or os.cpu_count()
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _build_subject,
+                    {header: column[patient] for header, column in columns.items()},
+                    *build_args,
+                ): patient
+                for patient in range(num_row)
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=num_row,
+                desc="Constructing queue for " + loader_type + " data",
+            ):
+                results[futures[future]] = future.result()
+
+        if sanity_manifest_path is not None:
+            Path(parameters["output_dir"]).mkdir(parents=True, exist_ok=True)
+            temp_path = sanity_manifest_path + "." + str(os.getpid())
+            with open(temp_path, "w") as f:
+                json.dump(sorted(validated_subjects), f)
+            os.replace(temp_path, sanity_manifest_path)
+
+        # preserve the order of the dataframe
+        for subject, subject_id_error in results:
+            if subject_id_error is not None:
+                subjects_with_error.append(subject_id_error)
+            if subject is not None:
+                subjects_list.append(subject)
+
+        assert (
+            subjects_with_error is not None
+        ), f"The following subjects could not be loaded, please recheck or remove and retry: {subjects_with_error}"
+
+        subjects_dataset = torchio.SubjectsDataset(subjects_list, transform=transform)
     if not train:
         return subjects_dataset
 
     # initialize the sampler
     sampler_obj = global_sampler_dict[sampler["type"]](patch_size)
-    if sampler["type"] in ("weighted", "weightedsampler", "weightedsample"):
+    if sampler["type"] in _WEIGHTED:
         sampler_obj = global_sampler_dict[sampler["type"]](
             patch_size, probability_map="label"
         )
-    elif sampler["type"] in ("label", "labelsampler", "labelsample"):
+    elif sampler["type"] in _LABEL:
         # if biased sampling is detected, then we need to pass the class probabilities
         if train and sampler["biased_sampling"]:
             # initialize the class probabilities dict
@@ -303,7 +856,8 @@ def ImagesFromDataFrame(
         samples_per_volume=q_samples_per_volume,
         sampler=sampler_obj,
         num_workers=q_num_workers,
-        shuffle_subjects=True,
+        # the lazy dataset shuffles the subjects itself
+        shuffle_subjects=not lazy_dataset,
         shuffle_patches=True,
         verbose=q_verbose,
     )
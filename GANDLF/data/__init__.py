@@ -1,6 +1,9 @@
+from typing import Union
+import torch
 from torch.utils.data import DataLoader
 
 from .ImagesFromDataFrame import ImagesFromDataFrame
+from .cuda_prefetcher import CudaPrefetcher, collate_into_pinned_memory
 from GANDLF.utils.write_parse import get_dataframe
 from GANDLF.utils import populate_channel_keys_in_params
 
@@ -13,10 +16,17 @@ def get_train_loader(params):
         params (dict): Dictionary of parameters.
 
     Returns:
-        torch.utils.data.DataLoader: The training loader.
+        Union[torch.utils.data.DataLoader, CudaPrefetcher]: The training loader.
     """
 
-    return DataLoader(
+    # the torchio queue spawns its own workers, so the sampling already overlaps with training;
+    # optionally, the copy to the GPU can also be overlapped by prefetching on a separate stream
+    gpu_prefetch = (
+        params.get("gpu_prefetch", False)
+        and torch.cuda.is_available()
+        and "cuda" in str(params.get("device", ""))
+    )
+    train_loader = DataLoader(
         ImagesFromDataFrame(
             get_dataframe(params["training_data"]),
             params,
@@ -25,8 +35,13 @@ def get_train_loader(params):
         ),
         batch_size=params["batch_size"],
         shuffle=True,
+        # when prefetching, the batches are collated directly into pinned memory
+        collate_fn=collate_into_pinned_memory if gpu_prefetch else None,
         pin_memory=False,  # params["pin_memory_dataloader"], # this is going OOM if True - needs investigation
     )
+    if gpu_prefetch:
+        return CudaPrefetcher(train_loader, params["device"])
+    return train_loader
 
 
 def get_validation_loader(params):
@@ -15,6 +15,7 @@ from .wrap_torchio import (
 from .rotations import rotate_90, rotate_180
 from .rgb_augs import colorjitter_transform
 from .hed_augs import hed_transform
+from .gpu_augs import get_gpu_augmentations, apply_gpu_augmentations
 
 # Defining a dictionary for augmentations - key is the string and the value is the augmentation object
 global_augs_dict = {
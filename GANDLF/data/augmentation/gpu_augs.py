@@ -0,0 +1,155 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from monai.transforms import (
+    Compose,
+    RandAffined,
+    RandGaussianNoised,
+    RandAdjustContrastd,
+    RandFlipd,
+)
+from monai.utils import convert_to_tensor
+
+# augmentations that can be applied to the batch after it has been sent to the device
+gpu_augmentations_available = ["affine", "noise", "gamma", "flip"]
+
+
+def _torchio_range_to_monai(
+    value: Union[float, List[float]],
+    scale: Optional[float] = 1,
+    offset: Optional[float] = 0,
+) -> List[Tuple[float, float]]:
+    """
+    Converts a torchio-style range (d, (a, b) or (a1, b1, a2, b2, a3, b3)) to the per-axis ranges expected by monai.
+
+    Args:
+        value (Union[float, List[float]]): The torchio range; a single value d is interpreted as (offset - d, offset + d), as in torchio.
+        scale (Optional[float], optional): The factor to multiply the range with. Defaults to 1.
+        offset (Optional[float], optional): The value to subtract from the range. Defaults to 0.
+
+    Returns:
+        List[Tuple[float, float]]: The monai range of each of the three spatial axes.
+    """
+    if isinstance(value, (int, float)):
+        return [(-value * scale, value * scale)] * 3
+    value = [(v - offset) * scale for v in value]
+    if len(value) == 2:
+        return [tuple(value)] * 3
+    return [tuple(value[i : i + 2]) for i in range(0, len(value), 2)]
+
+
+def get_gpu_augmentations(parameters: dict) -> Optional[Compose]:
+    """
+    This function creates the on-device augmentations requested in parameters["gpu_augmentations"], using the configuration of the corresponding entries in parameters["data_augmentation"].
+
+    Args:
+        parameters (dict): The parameters dictionary.
+
+    Returns:
+        Optional[Compose]: The composed augmentations, or None if no augmentations are to be applied on the device.
+    """
+    augmentations = parameters["data_augmentation"]
+    gpu_augmentations = parameters.get("gpu_augmentations", None)
+    if not gpu_augmentations or not augmentations:
+        return None
+
+    keys, image_key = ["image", "label"], ["image"]
+    is_2d = parameters["model"]["dimension"] == 2
+    transforms = []
+    for aug in gpu_augmentations:
+        aug_lower = aug.lower()
+        assert (
+            aug_lower in gpu_augmentations_available
+        ), f"Augmentation '{aug}' cannot be applied on the device, choose from {gpu_augmentations_available}"
+        if aug_lower not in augmentations:
+            continue
+        aug_params = augmentations[aug_lower]
+        if aug_lower == "affine":
+            rotate_range = _torchio_range_to_monai(
+                aug_params["degrees"], scale=np.pi / 180
+            )
+            # torchio defines absolute scaling factors, monai defines offsets from 1
+            scale_range = _torchio_range_to_monai(aug_params["scales"], offset=1)
+            translate_range = _torchio_range_to_monai(aug_params["translation"])
+            if is_2d:
+                # as in torchio, 2D patches of shape (C, H, W, 1) are only rotated in-plane (around
+                # the singleton axis), and are neither scaled nor translated along it
+                rotate_range = [(0.0, 0.0), (0.0, 0.0), rotate_range[2]]
+                scale_range = scale_range[:2] + [(0.0, 0.0)]
+                translate_range = translate_range[:2] + [(0.0, 0.0)]
+            transforms.append(
+                RandAffined(
+                    keys=keys,
+                    prob=aug_params["probability"],
+                    rotate_range=rotate_range,
+                    scale_range=scale_range,
+                    translate_range=translate_range,
+                    mode=("bilinear", "nearest"),
+                    padding_mode="zeros",
+                    allow_missing_keys=True,
+                )
+            )
+        elif aug_lower == "noise":
+            transforms.append(
+                RandGaussianNoised(
+                    keys=image_key,
+                    prob=aug_params["probability"],
+                    mean=float(np.mean(aug_params["mean"])),
+                    std=float(np.max(aug_params["std"])),
+                )
+            )
+        elif aug_lower == "gamma":
+            # same range as the default of torchio.transforms.RandomGamma
+            transforms.append(
+                RandAdjustContrastd(
+                    keys=image_key,
+                    prob=aug_params["probability"],
+                    gamma=(np.exp(-0.3), np.exp(0.3)),
+                )
+            )
+        elif aug_lower == "flip":
+            # flip each axis independently, as torchio does
+            for axis in aug_params["axis"]:
+                transforms.append(
+                    RandFlipd(
+                        keys=keys,
+                        prob=aug_params["probability"],
+                        spatial_axis=axis,
+                        allow_missing_keys=True,
+                    )
+                )
+
+    if not transforms:
+        return None
+    return Compose(transforms)
+
+
+def apply_gpu_augmentations(
+    transform: Compose, image: torch.Tensor, label: Optional[torch.Tensor] = None
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    This function applies the on-device augmentations to each sample of a batch.
+
+    Args:
+        transform (Compose): The augmentations, as returned by get_gpu_augmentations.
+        image (torch.Tensor): The batch of images, of shape (B, C, ...).
+        label (Optional[torch.Tensor], optional): The batch of segmentation labels, of shape (B, C, ...); spatial augmentations are applied to it consistently with the image. Defaults to None.
+
+    Returns:
+        Tuple[torch.Tensor, Optional[torch.Tensor]]: The augmented images and labels.
+    """
+    images_augmented, labels_augmented = [], []
+    for i in range(image.shape[0]):
+        sample = {"image": image[i]}
+        if label is not None:
+            sample["label"] = label[i]
+        sample = transform(sample)
+        images_augmented.append(convert_to_tensor(sample["image"]))
+        if label is not None:
+            labels_augmented.append(convert_to_tensor(sample["label"]))
+
+    image = torch.stack(images_augmented).to(image.dtype)
+    if label is not None:
+        label = torch.stack(labels_augmented).to(label.dtype)
+    return image, label
@@ -0,0 +1,107 @@
+from typing import Iterator, List, Union
+
+import torch
+import torchio
+from torch.utils.data import DataLoader, default_collate
+
+
+def collate_into_pinned_memory(batch: List[dict]) -> dict:
+    """
+    Collates torchio subjects (or patches) such that the image tensors are copied once, directly into a pinned batch tensor. The default collation followed by pin_memory copies each image tensor twice.
+
+    Args:
+        batch (List[dict]): The samples to collate.
+
+    Returns:
+        dict: The collated batch.
+    """
+    first = batch[0]
+    image_keys = [
+        key
+        for key, value in first.items()
+        if isinstance(value, dict) and torchio.DATA in value
+    ]
+
+    images_data = {}
+    for key in image_keys:
+        data = first[key][torchio.DATA]
+        for sample in batch:
+            assert (
+                sample[key][torchio.DATA].shape == data.shape
+            ), f"All samples in a batch need to have the same shape for '{key}'"
+        out = torch.empty((len(batch), *data.shape), dtype=data.dtype, pin_memory=True)
+        for i, sample in enumerate(batch):
+            out[i].copy_(sample[key][torchio.DATA])
+        images_data[key] = out
+
+    # everything else (affine, path, subject_id, etc.) is collated as usual
+    collated = default_collate(
+        [
+            {
+                key: (
+                    {k: v for k, v in value.items() if k != torchio.DATA}
+                    if key in images_data
+                    else value
+                )
+                for key, value in sample.items()
+            }
+            for sample in batch
+        ]
+    )
+    for key, data in images_data.items():
+        collated[key][torchio.DATA] = data
+    return collated
+
+
+class CudaPrefetcher:
+    def __init__(self, loader: DataLoader, device: Union[str, torch.device]) -> None:
+        """
+        Wraps a dataloader so that the image tensors of the next batch are copied to the GPU on a dedicated stream while the current batch is being processed.
+
+        Args:
+            loader (DataLoader): The dataloader to wrap; it should use pinned memory for the copies to be asynchronous.
+            device (Union[str, torch.device]): The CUDA device to copy the batches to.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _to_device(self, batch: dict) -> dict:
+        """
+        Asynchronously copies the image tensors of a batch to the device; all other entries are left untouched.
+
+        Args:
+            batch (dict): The collated batch of torchio subjects.
+
+        Returns:
+            dict: The batch with the image tensors on the device.
+        """
+        with torch.cuda.stream(self.stream):
+            for value in batch.values():
+                if isinstance(value, dict) and torchio.DATA in value:
+                    value[torchio.DATA] = value[torchio.DATA].to(
+                        self.device, non_blocking=True
+                    )
+        return batch
+
+    def __iter__(self) -> Iterator[dict]:
+        loader_iterator = iter(self.loader)
+        next_batch = next(loader_iterator, None)
+        if next_batch is not None:
+            next_batch = self._to_device(next_batch)
+        while next_batch is not None:
+            # ensure the copy of the current batch has finished before it is used
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            for value in batch.values():
+                if isinstance(value, dict) and torchio.DATA in value:
+                    value[torchio.DATA].record_stream(
+                        torch.cuda.current_stream(self.device)
+                    )
+            next_batch = next(loader_iterator, None)
+            if next_batch is not None:
+                next_batch = self._to_device(next_batch)
+            yield batch
@@ -0,0 +1,56 @@
+import torch
+
+from torchio.data.subject import Subject
+from torchio.transforms.intensity_transform import IntensityTransform
+
+# the key under which the quantization parameters are stored in the subject
+QUANTIZATION_KEY = "quantization"
+
+
+def quantize_subject(subject: Subject) -> Subject:
+    """
+    This function stores the intensity images of a loaded subject in 16 bits to halve their memory footprint. Integer-valued images are stored losslessly as int16 (with an offset), and all others are min-max scaled to float16.
+
+    Args:
+        subject (Subject): The loaded subject; modified in-place.
+
+    Returns:
+        Subject: The quantized subject, which needs to be restored with Dequantize before any other transform.
+    """
+    quantization = {}
+    for name, image in subject.get_images_dict(intensity_only=True).items():
+        data = image.data
+        if data.element_size() <= 2:
+            continue
+        data = data.float()
+        data_min, data_max = data.min().item(), data.max().item()
+        if (data_max - data_min < 2**16) and torch.equal(data, torch.round(data)):
+            scale, zero_point = 1.0, data_min + 2**15
+            image.set_data((data - zero_point).to(torch.int16))
+        else:
+            scale, zero_point = (data_max - data_min) or 1.0, data_min
+            image.set_data(((data - zero_point) / scale).to(torch.float16))
+        quantization[name] = (scale, zero_point)
+    subject[QUANTIZATION_KEY] = quantization
+    return subject
+
+
+class Dequantize(IntensityTransform):
+    """
+    Restore the intensity images of a subject quantized by :func:`quantize_subject` to single precision.
+
+    Args:
+        **kwargs: See :class:`~torchio.transforms.Transform` for additional keyword arguments.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.args_names = ()
+
+    def apply_transform(self, subject: Subject) -> Subject:
+        # the parameters are removed so that they are not collated into the batch
+        quantization = subject.pop(QUANTIZATION_KEY, {})
+        images = subject.get_images_dict(intensity_only=True)
+        for name, (scale, zero_point) in quantization.items():
+            images[name].set_data(images[name].data.float() * scale + zero_point)
+        return subject
@@ -5,6 +5,8 @@ os.environ["TORCHIO_HIDE_CITATION_PROMPT"] = "1"
 
 from .imaging import (
     resize_image,
+    resize_images_batch,
+    resize_image_gpu,
     resample_image,
     perform_sanity_check_on_subject,
     write_training_patches,
@@ -3,12 +3,66 @@ import os, pathlib, math, copy
 from enum import Enum
 import numpy as np
 import SimpleITK as sitk
+import torch
 import torchio
 import cv2
 
 from .generic import get_filename_extension_sanitized
 
 
+def _get_resampled_size(
+    input_image: sitk.Image, spacing: Union[np.ndarray, List[float], Tuple[float]]
+) -> List[int]:
+    """
+    This function computes the size of the input image after resampling it to the given spacing.
+
+    Args:
+        input_image (sitk.Image): The input image.
+        spacing (Union[np.ndarray, List[float], Tuple[float]]): The desired spacing.
+
+    Returns:
+        List[int]: The size of the resampled image.
+    """
+    inSpacing = input_image.GetSpacing()
+    inSize = input_image.GetSize()
+    return [
+        int(math.ceil(inSize[i] * (inSpacing[i] / spacing[i])))
+        for i in range(input_image.GetDimension())
+    ]
+
+
+def _get_resized_spacing(
+    input_image: sitk.Image, output_size: Union[np.ndarray, list, tuple, dict]
+) -> np.ndarray:
+    """
+    This function computes the spacing of the input image after resizing it to the given size.
+
+    Args:
+        input_image (sitk.Image): The input image.
+        output_size (Union[np.ndarray, list, tuple, dict]): The desired output size.
+
+    Returns:
+        np.ndarray: The spacing of the resized image.
+    """
+    inputSize = input_image.GetSize()
+    inputSpacing = np.array(input_image.GetSpacing())
+    outputSpacing = np.array(inputSpacing)
+
+    output_size_parsed = output_size
+    if isinstance(output_size, dict):
+        if "resize" in output_size:
+            output_size_parsed = output_size["resize"]
+
+    assert len(output_size_parsed) == len(
+        inputSpacing
+    ), "The output size dimension is inconsistent with the input dataset, please check parameters."
+
+    for i, n in enumerate(output_size_parsed):
+        outputSpacing[i] = outputSpacing[i] * (inputSize[i] / n)
+
+    return outputSpacing
+
+
 def resample_image(
     input_image: sitk.Image,
     spacing: Union[np.ndarray, List[float], Tuple[float]],
@@ -35,12 +89,7 @@ def resample_image(
 
     # Set Size
     if size is None:
-        inSpacing = input_image.GetSpacing()
-        inSize = input_image.GetSize()
-        size = [
-            int(math.ceil(inSize[i] * (inSpacing[i] / spacing[i])))
-            for i in range(input_image.GetDimension())
-        ]
+        size = _get_resampled_size(input_image, spacing)
 
     assert (
         len(size) == input_image.GetDimension()
@@ -61,7 +110,7 @@ def resample_image(
 
 def resize_image(
     input_image: sitk.Image,
-    output_size: Union[np.ndarray, list, tuple],
+    output_size: Union[np.ndarray, list, tuple, dict],
     interpolator: Optional[Enum] = sitk.sitkLinear,
 ) -> sitk.Image:
     """
@@ -69,30 +118,129 @@ def resize_image(
 
     Args:
         input_image (sitk.Image): The input image to be resized.
-        output_size (Union[np.ndarray, list, tuple]): The desired output size for the resized image.
+        output_size (Union[np.ndarray, list, tuple, dict]): The desired output size for the resized image.
         interpolator (Optional[Enum], optional): The desired interpolator. Defaults to sitk.sitkLinear.
 
     Returns:
         sitk.Image: The resized image.
     """
-    output_size_parsed = None
-    inputSize = input_image.GetSize()
-    inputSpacing = np.array(input_image.GetSpacing())
-    outputSpacing = np.array(inputSpacing)
+    outputSpacing = _get_resized_spacing(input_image, output_size)
+    return resample_image(input_image, outputSpacing, interpolator=interpolator)
 
-    output_size_parsed = output_size
-    if isinstance(output_size, dict):
-        if "resize" in output_size:
-            output_size_parsed = output_size["resize"]
 
-    assert len(output_size_parsed) == len(
-        inputSpacing
-    ), "The output size dimension is inconsistent with the input dataset, please check parameters."
+def resize_images_batch(
+    input_images: List[sitk.Image],
+    output_size: Union[np.ndarray, list, tuple, dict],
+    interpolators: List[Enum],
+) -> List[sitk.Image]:
+    """
+    This function resizes images that share the same geometry (such as the channels and label of a subject) to the same output size. The output grid is computed once, and a single resample filter is reused for all images.
 
-    for i, n in enumerate(output_size_parsed):
-        outputSpacing[i] = outputSpacing[i] * (inputSize[i] / n)
+    Args:
+        input_images (List[sitk.Image]): The input images to be resized.
+        output_size (Union[np.ndarray, list, tuple, dict]): The desired output size for the resized images.
+        interpolators (List[Enum]): The desired interpolator for each image.
 
-    return resample_image(input_image, outputSpacing, interpolator=interpolator)
+    Returns:
+        List[sitk.Image]: The resized images, in the same order as the input images.
+    """
+    if len(input_images) == 0:
+        return []
+
+    reference = input_images[0]
+    # same output grid as resize_image
+    outputSpacing = _get_resized_spacing(reference, output_size)
+    outputSize = _get_resampled_size(reference, outputSpacing)
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(outputSize)
+    resampler.SetOutputSpacing(outputSpacing.tolist())
+    resampler.SetOutputOrigin(reference.GetOrigin())
+    resampler.SetOutputDirection(reference.GetDirection())
+    resampler.SetTransform(sitk.Transform())
+    resampler.SetDefaultPixelValue(0)
+
+    output_images = []
+    for input_image, interpolator in zip(input_images, interpolators):
+        # images with a different geometry cannot share the output grid
+        if (
+            input_image.GetSize() != reference.GetSize()
+            or input_image.GetSpacing() != reference.GetSpacing()
+            or input_image.GetOrigin() != reference.GetOrigin()
+            or input_image.GetDirection() != reference.GetDirection()
+        ):
+            output_images.append(resize_image(input_image, output_size, interpolator))
+            continue
+        resampler.SetInterpolator(interpolator)
+        output_images.append(resampler.Execute(input_image))
+
+    return output_images
+
+
+def resize_image_gpu(
+    input_image: sitk.Image,
+    output_size: Union[np.ndarray, list, tuple, dict],
+    interpolator: Optional[Enum] = sitk.sitkLinear,
+) -> sitk.Image:
+    """
+    This function is the GPU counterpart of resize_image: the image is resampled on the same grid (origin, direction and output spacing) with torch.nn.functional.grid_sample.
+
+    Args:
+        input_image (sitk.Image): The input image to be resized.
+        output_size (Union[np.ndarray, list, tuple, dict]): The desired output size for the resized image.
+        interpolator (Optional[Enum], optional): The desired interpolator; only linear and nearest neighbor are supported on the GPU, others fall back to resize_image. Defaults to sitk.sitkLinear.
+
+    Returns:
+        sitk.Image: The resized image.
+    """
+    if (input_image.GetNumberOfComponentsPerPixel() > 1) or (
+        interpolator not in (sitk.sitkLinear, sitk.sitkNearestNeighbor)
+    ):
+        return resize_image(input_image, output_size, interpolator)
+
+    input_size = input_image.GetSize()
+    output_spacing = _get_resized_spacing(input_image, output_size)
+    output_size_resampled = _get_resampled_size(input_image, output_spacing)
+
+    # as in resize_image, output voxel k is located at input index k * input_size / output_size along each axis
+    device = torch.device("cuda")
+    grid_per_axis, inside_per_axis = [], []
+    for size, in_spacing, out_spacing, n in zip(
+        input_size, input_image.GetSpacing(), output_spacing, output_size_resampled
+    ):
+        index = torch.arange(n, device=device) * float(out_spacing / in_spacing)
+        grid_per_axis.append(index * 2 / (size - 1) - 1 if size > 1 else index * 0)
+        # SimpleITK clamps to the edge voxels up to half a voxel outside the image, and uses 0 beyond
+        inside_per_axis.append(index < size - 0.5)
+    # numpy arrays are indexed as [z, ]y, x while grid_sample expects the grid as x, y[, z]
+    grid = torch.stack(
+        torch.meshgrid(*reversed(grid_per_axis), indexing="ij")[::-1], dim=-1
+    )
+    inside = torch.ones(grid.shape[:-1], dtype=torch.bool, device=device)
+    for axis, inside_axis in enumerate(reversed(inside_per_axis)):
+        shape = [1] * inside.dim()
+        shape[axis] = -1
+        inside = inside & inside_axis.view(shape)
+
+    input_array = sitk.GetArrayFromImage(input_image)
+    input_tensor = torch.from_numpy(input_array.astype(np.float32)).to(device)
+    output_tensor = torch.nn.functional.grid_sample(
+        input_tensor[None, None],
+        grid[None].to(input_tensor.dtype),
+        mode="bilinear" if interpolator == sitk.sitkLinear else "nearest",
+        padding_mode="border",
+        align_corners=True,
+    )[0, 0]
+    output_tensor = torch.where(inside, output_tensor, torch.zeros_like(output_tensor))
+    output_array = output_tensor.cpu().numpy()
+    if np.issubdtype(input_array.dtype, np.integer):
+        output_array = np.round(output_array)
+
+    output_image = sitk.GetImageFromArray(output_array.astype(input_array.dtype))
+    output_image.SetSpacing(output_spacing.tolist())
+    output_image.SetOrigin(input_image.GetOrigin())
+    output_image.SetDirection(input_image.GetDirection())
+    return output_image
 
 
 def softer_sanity_check(
@@ -230,7 +378,7 @@ def write_training_patches(subject: torchio.Subject, params: dict) -> None:
     ext = get_filename_extension_sanitized(subject["path_to_metadata"][0])
     for key in params["channel_keys"]:
         img_to_write = torchio.ScalarImage(
-            tensor=subject[key][torchio.DATA][0], affine=subject[key]["affine"][0]
+            tensor=subject[key][torchio.DATA][0].cpu(), affine=subject[key]["affine"][0]
         ).as_sitk()
         sitk.WriteImage(
             img_to_write,
@@ -239,7 +387,7 @@ def write_training_patches(subject: torchio.Subject, params: dict) -> None:
 
     if params["label_keys"] is not None:
         img_to_write = torchio.ScalarImage(
-            tensor=subject[params["label_keys"][0]][torchio.DATA][0],
+            tensor=subject[params["label_keys"][0]][torchio.DATA][0].cpu(),
             affine=subject[key]["affine"][0],
         ).as_sitk()
         sitk.WriteImage(
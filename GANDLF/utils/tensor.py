@@ -418,8 +418,12 @@ def get_class_imbalance_weights(
                     training_df, parameters=params, train=False, loader_type="penalty"
                 )
 
+                # the lazy dataset is iterable, and cannot be shuffled by the data loader
                 penalty_loader = DataLoader(
-                    penalty_data, batch_size=1, shuffle=True, pin_memory=False
+                    penalty_data,
+                    batch_size=1,
+                    shuffle=not params.get("lazy_dataset", False),
+                    pin_memory=False,
                 )
 
                 (
@@ -1,5 +1,6 @@
 from pathlib import Path
-import gdown, zipfile, os, csv, random, copy, shutil, yaml, torch, pytest
+import gdown, zipfile, os, csv, random, copy, shutil, yaml, json, torch, pytest
+import nibabel as nib
 import SimpleITK as sitk
 import numpy as np
 import pandas as pd
@@ -7,11 +8,27 @@ import pandas as pd
 from pydicom.data import get_testdata_file
 import cv2
 
-from GANDLF.data.ImagesFromDataFrame import ImagesFromDataFrame
+from GANDLF.data.ImagesFromDataFrame import (
+    ImagesFromDataFrame,
+    _check_files_exist,
+    _get_sanity_check_key,
+    _get_zarr_dtype,
+    _read_spacing,
+    _resized_cached,
+)
 from GANDLF.utils import *
 from GANDLF.utils import parseTestingCSV, get_tensor_from_image
 from GANDLF.data.preprocessing import global_preprocessing_dict
-from GANDLF.data.augmentation import global_augs_dict
+from GANDLF.data.preprocessing.quantization import (
+    quantize_subject,
+    Dequantize,
+    QUANTIZATION_KEY,
+)
+from GANDLF.data.augmentation import (
+    global_augs_dict,
+    get_gpu_augmentations,
+    apply_gpu_augmentations,
+)
 from GANDLF.data.patch_miner.opm.utils import (
     generate_initial_mask,
     alpha_rgb_2d_channel_check,
@@ -21,6 +38,7 @@ from GANDLF.data.patch_miner.opm.utils import (
 )
 from GANDLF.config_manager import ConfigManager
 from GANDLF.parseConfig import parseConfig
+from GANDLF.compute.generic import create_pytorch_objects
 from GANDLF.training_manager import TrainingManager
 from GANDLF.inference_manager import InferenceManager
 from GANDLF.cli import (
@@ -1804,6 +1822,36 @@ def test_generic_preprocess_functions():
     input_transformed = resize_image(input_image, output_size_dict)
     assert list(input_transformed.GetSize()) == expected_output, "Resize should work"
 
+    # resizing images together should be identical to resizing them individually
+    input_image = sitk.GetImageFromArray(np.random.rand(20, 24, 28).astype(np.float32))
+    input_image.SetSpacing((0.5, 1.0, 2.0))
+    input_image.SetOrigin((1.0, 2.0, 3.0))
+    label_image = sitk.GetImageFromArray(
+        np.random.randint(0, 3, size=(20, 24, 28)).astype(np.uint8)
+    )
+    label_image.CopyInformation(input_image)
+    for output_size in [[14, 12, 10], {"resize": [42, 36, 30]}]:
+        images_resized = resize_images_batch(
+            [input_image, label_image],
+            output_size,
+            [sitk.sitkLinear, sitk.sitkNearestNeighbor],
+        )
+        for image, interpolator, image_resized in zip(
+            [input_image, label_image],
+            [sitk.sitkLinear, sitk.sitkNearestNeighbor],
+            images_resized,
+        ):
+            expected = resize_image(image, output_size, interpolator)
+            assert (
+                image_resized.GetSize() == expected.GetSize()
+            ), "Batch resize should have the same size as resize_image"
+            assert (
+                image_resized.GetSpacing() == expected.GetSpacing()
+            ), "Batch resize should have the same spacing as resize_image"
+            assert np.array_equal(
+                sitk.GetArrayFromImage(image_resized), sitk.GetArrayFromImage(expected)
+            ), "Batch resize should be identical to resize_image"
+
     sanitize_outputDir()
 
     print("passed")
@@ -3145,3 +3193,423 @@ def test_generic_data_split():
     sanitize_outputDir()
 
     print("passed")
+
+
+def test_generic_sanity_check_manifest_key():
+    print("52: Starting test for the key of the sanity check manifest")
+    sanitize_outputDir()
+    image_paths = []
+    for name in ["image.nii.gz", "label.nii.gz"]:
+        image_paths.append(os.path.join(outputDir, name))
+        sitk.WriteImage(
+            sitk.GetImageFromArray(np.zeros((4, 4, 4), dtype=np.uint8)), image_paths[-1]
+        )
+
+    key = _get_sanity_check_key(image_paths, "None|False")
+    assert key == _get_sanity_check_key(
+        list(reversed(image_paths)), "None|False"
+    ), "The key should not depend on the order of the images"
+    assert key != _get_sanity_check_key(
+        image_paths, "[64, 64, 64]|False"
+    ), "The key should change with the resize configuration"
+    assert key != _get_sanity_check_key(
+        image_paths, "None|True"
+    ), "The key should change with the memory save mode"
+    mtime = os.path.getmtime(image_paths[0])
+    os.utime(image_paths[0], (mtime + 10, mtime + 10))
+    assert key != _get_sanity_check_key(
+        image_paths, "None|False"
+    ), "The key should change when an image is modified"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_generic_gpu_augmentations_2d():
+    print("53: Starting test for on-device augmentations of 2D patches")
+    parameters = {
+        "model": {"dimension": 2},
+        "data_augmentation": {
+            "affine": {
+                "probability": 1.0,
+                "scales": 0.1,
+                "degrees": 15,
+                "translation": 2,
+            }
+        },
+        "gpu_augmentations": ["affine"],
+    }
+    transform = get_gpu_augmentations(parameters)
+    assert transform is not None, "On-device affine augmentation should be created"
+
+    # 2D patches have a singleton last spatial axis
+    image = torch.ones(2, 3, 64, 64, 1)
+    label = torch.ones(2, 1, 64, 64, 1)
+    image_augmented, label_augmented = apply_gpu_augmentations(transform, image, label)
+    assert image_augmented.shape == image.shape, "Image shape should be preserved"
+    assert label_augmented.shape == label.shape, "Label shape should be preserved"
+    # out-of-plane rotations would move the content out of the single slice
+    assert (
+        image_augmented != 0
+    ).float().mean() > 0.75, "2D augmentation should keep the content in-plane"
+    assert (
+        label_augmented != 0
+    ).float().mean() > 0.75, "2D augmentation should keep the label in-plane"
+
+    print("passed")
+
+
+def test_generic_resize_cache():
+    print("54: Starting test for the cache of resized images")
+    sanitize_outputDir()
+    import torchio
+
+    # a lossy source format, which should not be used for the cache
+    input_path = os.path.join(outputDir, "image.jpg")
+    cv2.imwrite(input_path, np.random.randint(0, 255, size=(64, 64, 3), dtype=np.uint8))
+    image = torchio.ScalarImage(input_path)
+    cache_dir = os.path.join(outputDir, "cache")
+
+    # without an output directory, nothing is cached
+    images_resized = _resized_cached(
+        [image], [input_path], [32, 32, 1], [sitk.sitkLinear], None
+    )
+    assert not os.path.isdir(
+        os.path.join(cache_dir, "_resize_cache")
+    ), "Nothing should be cached without an output directory"
+
+    cold = _resized_cached(
+        [image], [input_path], [32, 32, 1], [sitk.sitkLinear], cache_dir
+    )
+    cached_files = os.listdir(os.path.join(cache_dir, "_resize_cache"))
+    assert len(cached_files) == 1, "The resized image should be cached"
+    assert cached_files[0].endswith(".nrrd"), "The cache should be lossless"
+    warm = _resized_cached(
+        [image], [input_path], [32, 32, 1], [sitk.sitkLinear], cache_dir
+    )
+    for resized in [cold[0], warm[0]]:
+        assert np.array_equal(
+            sitk.GetArrayFromImage(resized), sitk.GetArrayFromImage(images_resized[0])
+        ), "Cached images should be identical to freshly resized ones"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_generic_zarr_cache_dtype():
+    print("55: Starting test for the storage dtype of the zarr cache")
+    # integer-valued images within the int16 range are stored exactly
+    data = np.random.randint(-1024, 3072, size=(1, 8, 8, 8)).astype(np.float32)
+    assert _get_zarr_dtype(data) == np.int16, "Integer images should use int16"
+    data[0, 0, 0, 0] = 100000
+    assert _get_zarr_dtype(data) == np.float32, "Out of range images are kept"
+    # other images use half precision, unless they would overflow
+    data = np.random.rand(1, 8, 8, 8).astype(np.float32)
+    assert _get_zarr_dtype(data) == np.float16, "Float images should use float16"
+    data[0, 0, 0, 0] = 1e6 + 0.5
+    assert (
+        _get_zarr_dtype(data) == np.float32
+    ), "Float images exceeding the half precision range should use float32"
+    # data that is already small is kept as is
+    data = np.zeros((1, 8, 8, 8), dtype=np.uint8)
+    assert _get_zarr_dtype(data) == np.uint8, "Small dtypes should be kept"
+
+    print("passed")
+
+
+def test_generic_read_spacing():
+    print("56: Starting test for reading the spacing from image headers")
+    sanitize_outputDir()
+    image = sitk.GetImageFromArray(np.zeros((4, 4, 4), dtype=np.uint8))
+    image.SetSpacing((0.5, 1.0, 2.0))
+    for name in ["image.nii.gz", "image.nrrd"]:
+        image_path = os.path.join(outputDir, name)
+        sitk.WriteImage(image, image_path)
+        assert np.allclose(
+            _read_spacing(image_path, os.path.getmtime(image_path)),
+            sitk.ReadImage(image_path).GetSpacing(),
+        ), "Spacing should match the one read by SimpleITK"
+    # the extension is matched regardless of its case
+    image_path = os.path.join(outputDir, "image_upper.NII.GZ")
+    shutil.copyfile(os.path.join(outputDir, "image.nii.gz"), image_path)
+    assert np.allclose(
+        _read_spacing(image_path, os.path.getmtime(image_path)), image.GetSpacing()
+    ), "Spacing should be read from upper case NIfTI files"
+
+    # spacing in other units is converted to millimeters, as done by SimpleITK
+    for unit in ["meter", "micron"]:
+        image_path = os.path.join(outputDir, "image_" + unit + ".nii.gz")
+        nifti = nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.uint8), np.eye(4))
+        nifti.header.set_zooms((0.5, 1.0, 2.0))
+        nifti.header.set_xyzt_units(xyz=unit)
+        nib.save(nifti, image_path)
+        assert np.allclose(
+            _read_spacing(image_path, os.path.getmtime(image_path)),
+            sitk.ReadImage(image_path).GetSpacing(),
+        ), "Spacing should be converted to millimeters"
+
+    # a rewritten file is read again instead of being served from the cache
+    image_path = os.path.join(outputDir, "image.nrrd")
+    mtime = os.path.getmtime(image_path)
+    image.SetSpacing((1.5, 2.0, 3.0))
+    sitk.WriteImage(image, image_path)
+    os.utime(image_path, (mtime + 10, mtime + 10))
+    assert np.allclose(
+        _read_spacing(image_path, os.path.getmtime(image_path)), image.GetSpacing()
+    ), "Spacing of rewritten files should be read again"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a GPU")
+def test_generic_resize_image_gpu():
+    print("57: Starting test for resizing images on the GPU")
+    input_array = np.random.rand(20, 24, 28).astype(np.float32)
+    input_image = sitk.GetImageFromArray(input_array)
+    input_image.SetSpacing((0.5, 1.0, 2.0))
+    input_image.SetOrigin((1.0, 2.0, 3.0))
+    label_image = sitk.GetImageFromArray(
+        np.random.randint(0, 3, size=(20, 24, 28)).astype(np.uint8)
+    )
+    label_image.CopyInformation(input_image)
+
+    for image, interpolator, output_size in [
+        (input_image, sitk.sitkLinear, [42, 36, 30]),
+        (input_image, sitk.sitkLinear, [14, 12, 10]),
+        (label_image, sitk.sitkNearestNeighbor, [14, 12, 10]),
+    ]:
+        expected = resize_image(image, output_size, interpolator)
+        output = resize_image_gpu(image, output_size, interpolator)
+        assert output.GetSize() == expected.GetSize(), "Size should match"
+        assert np.allclose(
+            output.GetSpacing(), expected.GetSpacing()
+        ), "Spacing should match"
+        assert output.GetOrigin() == expected.GetOrigin(), "Origin should match"
+        # the interior voxels should be identical up to floating point errors
+        expected_array = sitk.GetArrayFromImage(expected)[1:-1, 1:-1, 1:-1]
+        output_array = sitk.GetArrayFromImage(output)[1:-1, 1:-1, 1:-1]
+        assert np.allclose(
+            output_array, expected_array, atol=1e-4
+        ), "Resizing on the GPU should match resize_image"
+
+    print("passed")
+
+
+def test_generic_quantization_round_trip():
+    print("58: Starting test for in-memory quantization of subjects")
+    import torchio
+
+    integer_data = torch.randint(-1024, 3072, (1, 16, 16, 16)).float()
+    float_data = torch.rand(1, 16, 16, 16) * 1000 - 200
+    subject = torchio.Subject(
+        integer=torchio.ScalarImage(tensor=integer_data.clone()),
+        floating=torchio.ScalarImage(tensor=float_data.clone()),
+        label=torchio.LabelMap(tensor=torch.randint(0, 3, (1, 16, 16, 16))),
+    )
+    subject = quantize_subject(subject)
+    assert subject["integer"].data.dtype == torch.int16, "Integers should use int16"
+    assert (
+        subject["floating"].data.dtype == torch.float16
+    ), "Other intensities should use float16"
+    assert subject["label"].data.dtype == torch.int64, "Labels should be untouched"
+    assert QUANTIZATION_KEY in subject, "Quantization parameters should be stored"
+
+    subject_restored = Dequantize()(subject)
+    assert (
+        subject_restored["integer"].data.dtype == torch.float32
+    ), "Restored images should use single precision"
+    assert torch.equal(
+        subject_restored["integer"].data, integer_data
+    ), "The int16 quantization should be exact"
+    # half precision has an 11-bit significand over the (min-max scaled) range
+    tolerance = (float_data.max() - float_data.min()).item() * 2**-10
+    assert torch.allclose(
+        subject_restored["floating"].data, float_data, atol=tolerance
+    ), "The float16 quantization should be within its precision"
+    # the parameters must not end up in the collated batch
+    assert (
+        QUANTIZATION_KEY not in subject_restored
+    ), "Quantization parameters should be removed by Dequantize"
+    batch = torch.utils.data.default_collate([subject_restored])
+    assert (
+        QUANTIZATION_KEY not in batch
+    ), "Quantization parameters should not be collated"
+
+    print("passed")
+
+
+def test_generic_check_files_exist():
+    print("59: Starting test for checking the existence of input files")
+    sanitize_outputDir()
+    # several files in one directory are checked with a single scan
+    scanned_dir = os.path.join(outputDir, "scanned")
+    Path(scanned_dir).mkdir(parents=True, exist_ok=True)
+    existing = os.path.join(scanned_dir, "image.nii.gz")
+    Path(existing).touch()
+    # a directory in place of a file
+    directory = os.path.join(scanned_dir, "label.nii.gz")
+    Path(directory).mkdir()
+    missing = os.path.join(scanned_dir, "missing.nii.gz")
+    symlink = os.path.join(scanned_dir, "link.nii.gz")
+    os.symlink(existing, symlink)
+    broken_symlink = os.path.join(scanned_dir, "broken_link.nii.gz")
+    os.symlink(missing, broken_symlink)
+    relative = os.path.relpath(existing)
+    # found on case-insensitive filesystems, even though the scan does not list it
+    different_case = os.path.join(scanned_dir, "IMAGE.nii.gz")
+    # a single file in a directory is checked directly
+    single_dir = os.path.join(outputDir, "single")
+    Path(single_dir).mkdir(parents=True, exist_ok=True)
+    single = os.path.join(single_dir, "image.nii.gz")
+    Path(single).touch()
+    single_relative_missing = os.path.relpath(os.path.join(outputDir, "missing.png"))
+
+    paths = [
+        existing,
+        directory,
+        missing,
+        symlink,
+        broken_symlink,
+        relative,
+        different_case,
+        single,
+        single_relative_missing,
+    ]
+    existence = _check_files_exist(paths)
+    assert set(existence.keys()) == set(paths), "All paths should be checked"
+    for path in paths:
+        assert existence[path] == os.path.isfile(
+            path
+        ), f"Existence of '{path}' should match os.path.isfile"
+    assert existence[existing] and existence[relative], "Existing files are found"
+    assert not existence[directory], "Directories are not files"
+    assert not existence[missing], "Missing files are not found"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_generic_dataloader_sanity_manifest():
+    print("60: Starting test for the sanity check manifest of the data loader")
+    parameters = ConfigManager(
+        testingDir + "/config_segmentation.yaml", version_check_flag=False
+    )
+    training_data, parameters["headers"] = parseTrainingCSV(
+        inputDir + "/train_3d_rad_segmentation.csv"
+    )
+    parameters["patch_size"] = patch_size["3D"]
+    parameters["model"]["dimension"] = 3
+    parameters = populate_header_in_parameters(parameters, parameters["headers"])
+    parameters["data_preprocessing"] = {}
+    sanitize_outputDir()
+    parameters["output_dir"] = outputDir
+    manifest_path = os.path.join(outputDir, "sanity_ok.json")
+
+    # subjects read from files are recorded once checked, and skipped afterwards
+    dataset = ImagesFromDataFrame(training_data, parameters, False, "unit_test")
+    with open(manifest_path) as f:
+        validated_subjects = json.load(f)
+    assert len(validated_subjects) == len(
+        dataset
+    ), "All checked subjects should be recorded"
+    dataset_warm = ImagesFromDataFrame(training_data, parameters, False, "unit_test")
+    assert len(dataset_warm) == len(dataset), "Recorded subjects should be loaded"
+    with open(manifest_path) as f:
+        assert (
+            json.load(f) == validated_subjects
+        ), "The manifest should not change for unchanged subjects"
+
+    # subjects resized in memory are not actually compared, and are not recorded
+    sanitize_outputDir()
+    parameters["data_preprocessing"] = {"resize_image": [16, 16, 16]}
+    dataset = ImagesFromDataFrame(training_data, parameters, False, "unit_test")
+    with open(manifest_path) as f:
+        assert (
+            len(json.load(f)) == 0
+        ), "Subjects resized in memory should not be recorded"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_generic_dataloader_zarr_cache():
+    print("61: Starting test for the zarr cache of the data loader")
+    parameters = ConfigManager(
+        testingDir + "/config_segmentation.yaml", version_check_flag=False
+    )
+    training_data, parameters["headers"] = parseTrainingCSV(
+        inputDir + "/train_3d_rad_segmentation.csv"
+    )
+    parameters["patch_size"] = patch_size["3D"]
+    parameters["model"]["dimension"] = 3
+    parameters = populate_header_in_parameters(parameters, parameters["headers"])
+    parameters["data_preprocessing"] = {}
+    sanitize_outputDir()
+    parameters["output_dir"] = outputDir
+
+    dataset = ImagesFromDataFrame(training_data, parameters, False, "unit_test")
+    parameters["cache_backend"] = "zarr"
+    dataset_cold = ImagesFromDataFrame(training_data, parameters, False, "unit_test")
+    assert os.path.isdir(
+        os.path.join(outputDir, "_zarr_cache")
+    ), "The zarr cache should be written"
+    dataset_warm = ImagesFromDataFrame(training_data, parameters, False, "unit_test")
+
+    for key in parameters["headers"]["channelHeaders"] + ["label"]:
+        key = str(key)
+        expected = dataset[0][key].data.float()
+        for cached in [dataset_cold[0][key].data, dataset_warm[0][key].data]:
+            assert cached.shape == expected.shape, "Cached shape should match"
+            assert torch.allclose(
+                cached.float(), expected, rtol=1e-3, atol=1e-3
+            ), "Cached images should match the original ones"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_generic_channels_last_imagenet_unet_3d(device):
+    print("62: Starting test for channels-last layout of 3D imagenet_unet")
+    parameters = ConfigManager(
+        testingDir + "/config_segmentation.yaml", version_check_flag=False
+    )
+    parameters["modality"] = "rad"
+    parameters["patch_size"] = patch_size["3D"]
+    parameters["model"]["dimension"] = 3
+    parameters["model"]["class_list"] = [0, 1]
+    parameters["model"]["amp"] = False
+    parameters["model"]["num_channels"] = 1
+    parameters["model"]["architecture"] = "imagenet_unet"
+    parameters["model"]["encoder_name"] = "resnet34"
+    parameters["model"]["encoder_depth"] = 3
+    parameters["model"]["decoder_channels"] = (64, 32, 16)
+    parameters["model"]["pretrained"] = False
+    parameters["model"]["onnx_export"] = False
+    parameters["model"]["print_summary"] = False
+    parameters["channels_last"] = True
+    # the acs and soft converters hold 2D convolution weights in a 3D model
+    for converter_type in ["acs", "soft", "conv3d"]:
+        parameters["model"]["converter_type"] = converter_type
+        model, _, _, _, _, _ = create_pytorch_objects(
+            copy.deepcopy(parameters), device=device
+        )
+        for model_parameter in model.parameters():
+            if model_parameter.dim() == 5:
+                assert model_parameter.is_contiguous(
+                    memory_format=torch.channels_last_3d
+                ), "5D weights should be channels-last"
+        input_tensor = torch.rand(
+            1, 1, *parameters["patch_size"], device=next(model.parameters()).device
+        ).contiguous(memory_format=torch.channels_last_3d)
+        with torch.no_grad():
+            output = model(input_tensor)
+        assert output.shape[2:] == input_tensor.shape[2:], "Output shape should match"
+
+    print("passed")